@@ -1,12 +1,25 @@
+import asyncio
+import base64
+import errno
+import fcntl
+import functools
+import hashlib
+import json
+import math
 import os
+import shutil
+import socket
 import uuid
-import subprocess
+from contextlib import asynccontextmanager
 import tempfile
-from typing import Optional
+import time
+from typing import IO, Annotated, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+from urllib.parse import urljoin, urlparse
 
-import requests
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field, HttpUrl
+import httpx
+from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field
 
 
 # =========================
@@ -17,26 +30,142 @@ SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET", "audiofiles")
 OUTPUT_PREFIX = os.getenv("OUTPUT_PREFIX", "final")  # folder inside bucket
 
-app = FastAPI(title="Audio Mixer Service", version="1.2.0")
+# Renders at or above this size go through the resumable (TUS) upload endpoint
+RESUMABLE_UPLOAD_MIN_BYTES = int(os.getenv("RESUMABLE_UPLOAD_MIN_BYTES", str(50 * 1024 * 1024)))
+
+# Pipe ffmpeg's output straight into the upload instead of staging final.mp3.
+# Off by default: the piped MP3 has no seekable header to finalize and always
+# goes through the single-request upload, never the resumable one. The upload
+# lands under a temporary object name and is moved into place only once ffmpeg
+# has exited cleanly, so a failed render never publishes a truncated file.
+STREAM_UPLOAD = os.getenv("STREAM_UPLOAD", "false").lower() in ("1", "true", "yes")
+
+# LAME VBR settings: -q:a 0 (best, ~245 kbps) .. 9 (smallest); compression_level
+# 0 (slowest, best psychoacoustics) .. 9 (fastest)
+MP3_VBR_QUALITY = int(os.getenv("MP3_VBR_QUALITY", "4"))
+MP3_COMPRESSION_LEVEL = int(os.getenv("MP3_COMPRESSION_LEVEL", "5"))
+
+# Bitrate for output_format=opus
+OPUS_BITRATE = os.getenv("OPUS_BITRATE", "64k")
+
+# ffmpeg processes one worker may run at once; further jobs wait their turn
+# instead of oversubscribing the CPU. The default splits the cores across the
+# uvicorn workers (WEB_CONCURRENCY, exported by the Dockerfile).
+_WORKER_CPUS = max(1, (os.cpu_count() or 2) // int(os.getenv("WEB_CONCURRENCY", "1")))
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", str(_WORKER_CPUS)))
+
+# ffmpeg threading: codec threads and filtergraph worker threads. Pinned to each
+# job's share of the cores; left alone ffmpeg sizes every pool to the whole machine.
+_JOB_THREADS = max(1, _WORKER_CPUS // MAX_CONCURRENT_JOBS)
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", str(_JOB_THREADS)))
+FFMPEG_FILTER_THREADS = int(os.getenv("FFMPEG_FILTER_THREADS", str(_JOB_THREADS)))
+
+# State of ?background=true jobs, one JSON file per job so every uvicorn worker
+# can answer /jobs/{id}; kept for JOB_TTL_SECONDS
+JOBS_DIR = os.getenv("JOBS_DIR") or os.path.join(tempfile.gettempdir(), "mixer-jobs")
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", str(24 * 3600)))
+
+# Largest input file accepted (voice, bed, intro or outro)
+MAX_INPUT_BYTES = int(os.getenv("MAX_INPUT_BYTES", str(500 * 1024 * 1024)))
+
+# On-disk cache for music beds (music/intro/outro URLs); empty CACHE_DIR disables it
+CACHE_DIR = os.getenv("CACHE_DIR", "/var/cache/mixer")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Per-job scratch space. tmpfs keeps inputs and the rendered MP3 in RAM instead
+# of the container's overlay filesystem; only used when /dev/shm is big enough
+# to be worth it (Docker's default is 64 MB, run with --shm-size=1g or
+# --tmpfs /dev/shm:size=1g).
+def _default_job_tmpdir() -> Optional[str]:
+    try:
+        st = os.statvfs("/dev/shm")
+    except OSError:
+        return None
+    if st.f_frsize * st.f_blocks < 1024 * 1024 * 1024 or not os.access("/dev/shm", os.W_OK):
+        return None
+    return "/dev/shm/mixer"
+
+
+JOB_TMPDIR = os.getenv("JOB_TMPDIR") or _default_job_tmpdir()
+if JOB_TMPDIR:
+    os.makedirs(JOB_TMPDIR, exist_ok=True)
+
+# Jobs start in the system tempdir instead when JOB_TMPDIR has less free space
+JOB_TMPDIR_MIN_FREE = int(os.getenv("JOB_TMPDIR_MIN_FREE", str(500 * 1024 * 1024)))
+
+# Hosts ffmpeg may read from directly over HTTP(S) instead of us downloading the
+# file first (comma separated). Defaults to the Supabase host; anything else is
+# downloaded by the service, which also keeps ffmpeg from being used for SSRF.
+MEDIA_URL_ALLOWLIST = {
+    h.strip()
+    for h in os.getenv("MEDIA_URL_ALLOWLIST", urlparse(SUPABASE_URL).hostname or "").split(",")
+    if h.strip()
+}
+
+# One pooled client for every download/upload, so jobs reuse keep-alive
+# connections (and TLS sessions) to Supabase and the media hosts. The transport
+# retries failed connection attempts; _stream_get also retries 502/503/504.
+# Unreachable hosts fail fast on connect; slow reads get the long timeout.
+HTTP = httpx.AsyncClient(
+    timeout=httpx.Timeout(180, connect=10),
+    transport=httpx.AsyncHTTPTransport(
+        retries=3,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+    ),
+)
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    yield
+    await HTTP.aclose()
+
+
+# orjson serializes the response bodies in C instead of json.dumps.
+app = FastAPI(title="Audio Mixer Service", version="1.2.0", lifespan=_lifespan, default_response_class=ORJSONResponse)
+
+_FFMPEG_SLOTS = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+_ffmpeg_jobs = {"running": 0, "waiting": 0}  # reported by /health
+
+T = TypeVar("T")
+StdinFeeder = Callable[[asyncio.StreamWriter], Awaitable[None]]
 
 
 # =========================
 # Models
 # =========================
+def _check_http_url(value: str) -> str:
+    # Plain scheme/host check; we only pass these URLs through, so pydantic's
+    # full HttpUrl parsing and normalization isn't needed.
+    parsed = urlparse(value)
+    if parsed.scheme not in ("http", "https") or not parsed.netloc:
+        raise ValueError("must be an http(s) URL")
+    return value
+
+
+HttpUrlStr = Annotated[str, AfterValidator(_check_http_url)]
+
+
 class MixRequest(BaseModel):
-    voice_url: HttpUrl
-    music_url: HttpUrl
+    model_config = ConfigDict(extra="forbid")
+
+    voice_url: HttpUrlStr
+    music_url: HttpUrlStr
     music_volume: float = Field(default=0.18, ge=0.0, le=1.0)  # 0.0 - 1.0
     duck: bool = True
-    output_format: str = "mp3"
+    output_format: str = "mp3"  # mp3 | opus
     loudnorm: bool = True
+    # cheaper dynaudnorm instead of EBU R128 loudnorm (only used when loudnorm=True)
+    fast_loudnorm: bool = False
 
 
 class MixPodcastRequest(BaseModel):
-    voice_url: HttpUrl
+    model_config = ConfigDict(extra="forbid")
+
+    voice_url: HttpUrlStr
 
-    intro_music_url: HttpUrl
-    outro_music_url: HttpUrl
+    intro_music_url: HttpUrlStr
+    outro_music_url: HttpUrlStr
 
     intro_duration: float = Field(default=8.0, ge=0.0)
     outro_duration: float = Field(default=10.0, ge=0.0)
@@ -55,103 +184,987 @@ class MixPodcastRequest(BaseModel):
     outro_fade_out: float = Field(default=1.2, ge=0.0, le=10.0)
 
     loudnorm: bool = True
+    # cheaper dynaudnorm instead of EBU R128 loudnorm (only used when loudnorm=True)
+    fast_loudnorm: bool = False
+
+    output_format: str = "mp3"  # mp3 | opus
 
 
 # =========================
 # Helpers
 # =========================
-def _download_to(path: str, url: str):
-    with requests.get(url, stream=True, timeout=180) as r:
+def _job_tmpdir() -> Optional[str]:
+    # Checked per job: concurrent jobs share the tmpfs, and running out of
+    # space there fails the render, while the disk-backed default is only slower.
+    if JOB_TMPDIR and shutil.disk_usage(JOB_TMPDIR).free >= JOB_TMPDIR_MIN_FREE:
+        return JOB_TMPDIR
+    return None
+
+
+def _check_input_size(url: httpx.URL, size: int):
+    if size > MAX_INPUT_BYTES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Input too large: {url} exceeds {MAX_INPUT_BYTES} bytes",
+        )
+
+
+def _content_length(r: httpx.Response) -> Optional[int]:
+    # None when the header is missing or malformed; the body is then only
+    # checked while it is being read.
+    try:
+        length = int(r.headers.get("Content-Length", ""))
+    except ValueError:
+        return None
+    return length if length >= 0 else None
+
+
+async def _iter_body(r: httpx.Response) -> AsyncIterator[bytes]:
+    # aiter_bytes undoes any Content-Encoding; 1 MiB blocks keep the per-chunk
+    # Python overhead low. Oversized inputs are refused as soon as that is
+    # known: up front from Content-Length, otherwise while counting.
+    _check_input_size(r.url, _content_length(r) or 0)
+    received = 0
+    async for chunk in r.aiter_bytes(1024 * 1024):
+        received += len(chunk)
+        _check_input_size(r.url, received)
+        yield chunk
+
+
+async def _save_body(r: httpx.Response, path: str):
+    length = _content_length(r)
+    if length:
+        # Before the file is reserved below, not just once the body is read
+        _check_input_size(r.url, length)
+    with open(path, "wb") as f:
+        if length and "Content-Encoding" not in r.headers and hasattr(os, "posix_fallocate"):
+            # Reserve the whole file up front: one extent instead of growing
+            # it 1 MiB at a time.
+            try:
+                os.posix_fallocate(f.fileno(), 0, length)
+            except OSError:
+                pass
+        async for chunk in _iter_body(r):
+            f.write(chunk)
+
+
+@asynccontextmanager
+async def _stream_get(url: str, headers: Optional[dict[str, str]] = None, retries: int = 3):
+    for attempt in range(retries + 1):
+        async with HTTP.stream("GET", url, headers=headers, follow_redirects=True) as r:
+            if r.status_code not in (502, 503, 504) or attempt == retries:
+                yield r
+                return
+        await asyncio.sleep(0.3 * 2 ** attempt)
+
+
+async def _download_to(path: str, url: str):
+    async with _stream_get(url) as r:
         r.raise_for_status()
-        with open(path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 256):
-                if chunk:
-                    f.write(chunk)
+        await _save_body(r, path)
 
 
-def _supabase_upload(file_path: str, object_path: str, content_type: str = "audio/mpeg") -> str:
+# Sidecar suffix -> (response validator, conditional request header)
+_CACHE_VALIDATORS = {
+    ".etag": ("ETag", "If-None-Match"),
+    ".last-modified": ("Last-Modified", "If-Modified-Since"),
+}
+
+
+@asynccontextmanager
+async def _cache_lock(cached: str):
+    # Per-entry lock, shared by all uvicorn workers: a burst of jobs for the same
+    # new bed downloads it once and the rest revalidate with a 304. Polled with
+    # LOCK_NB so a cancelled job never leaves a thread blocked in flock.
+    fd = os.open(cached + ".lock", os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(0.05)
+        yield
+    finally:
+        os.close(fd)  # also releases the lock
+
+
+async def _cached_download(path: str, url: str):
+    # Music beds are reused across jobs: keep them in CACHE_DIR keyed by URL and
+    # revalidate with If-None-Match / If-Modified-Since, so a repeat job only
+    # pays for a 304.
+    if not CACHE_DIR:
+        return await _download_to(path, url)
+
+    # The cache is only an optimization: if CACHE_DIR can't be created, locked
+    # or written (read-only root, full volume, not ours), download into the
+    # job dir like an uncached input instead of failing the job.
+    try:
+        await _cached_download_unchecked(path, url)
+    except OSError:
+        await _download_to(path, url)
+
+
+async def _cached_download_unchecked(path: str, url: str):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cached = os.path.join(CACHE_DIR, hashlib.sha256(url.encode()).hexdigest())
+
+    async with _cache_lock(cached):
+        headers = {}
+        if os.path.exists(cached):
+            for suffix, (_, conditional) in _CACHE_VALIDATORS.items():
+                try:
+                    with open(cached + suffix) as f:
+                        headers[conditional] = f.read()
+                except FileNotFoundError:
+                    pass
+
+        async with _stream_get(url, headers=headers) as r:
+            if r.status_code == 304:
+                try:
+                    os.utime(cached)  # mark as recently used for eviction
+                    await _link_or_copy(cached, path)
+                except FileNotFoundError:
+                    # evicted by a concurrent job since we checked
+                    await _download_to(path, url)
+                return
+
+            r.raise_for_status()
+            # Write under a unique name and rename so concurrent jobs never see a
+            # half-written cache entry.
+            part = f"{cached}.{uuid.uuid4().hex}.part"
+            try:
+                await _save_body(r, part)
+            except BaseException:
+                # Failed or cancelled mid-body; eviction never sees .part files
+                try:
+                    os.remove(part)
+                except FileNotFoundError:
+                    pass
+                raise
+            await _link_or_copy(part, path)
+            os.replace(part, cached)
+            for suffix, (validator, _) in _CACHE_VALIDATORS.items():
+                value = r.headers.get(validator)
+                if value:
+                    with open(part, "w") as f:
+                        f.write(value)
+                    os.replace(part, cached + suffix)
+                elif os.path.exists(cached + suffix):
+                    os.remove(cached + suffix)
+
+    _evict_cache()
+
+
+async def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # cache and tempdir live on different filesystems (always the case
+        # with job dirs on tmpfs): copy the bed off the event loop
+        await asyncio.to_thread(shutil.copyfile, src, dst)
+
+
+def _evict_cache():
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith((*_CACHE_VALIDATORS, ".lock", ".part")):
+            continue
+        try:
+            st = os.stat(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        if name.endswith(".loudnorm"):
+            # Measurements are written with an atomic rename and never locked
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            continue
+        # Only evict beds no job holds right now. The (empty) lock file is
+        # kept: unlinking it would let the next job lock a fresh inode while
+        # another still holds the old one.
+        fd = os.open(os.path.join(CACHE_DIR, name + ".lock"), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            for victim in (name, *(name + suffix for suffix in _CACHE_VALIDATORS)):
+                try:
+                    os.remove(os.path.join(CACHE_DIR, victim))
+                except FileNotFoundError:
+                    pass
+        finally:
+            os.close(fd)
+        total -= size
+
+
+async def _gather_cancelling(*aws: Awaitable) -> list:
+    # asyncio.gather that cancels the remaining awaitables as soon as one fails
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _download_all(jobs: list[tuple[Callable[[str, str], Awaitable[None]], str, str]]):
+    # Inputs are independent and network-bound; fetch them concurrently so the
+    # download phase costs max(download) instead of sum(download). A failure
+    # cancels the siblings so nothing keeps writing into a tempdir that is
+    # about to be removed.
+    await _gather_cancelling(*(download(path, url) for download, path, url in jobs))
+
+
+async def _pipe_download(url: str, stdin: asyncio.StreamWriter):
+    # Feed a download straight into ffmpeg's stdin, so decoding starts with the
+    # first bytes instead of after the whole file is on disk.
+    try:
+        async with _stream_get(url) as r:
+            r.raise_for_status()
+            async for chunk in _iter_body(r):
+                stdin.write(chunk)
+                await stdin.drain()
+        stdin.close()
+        await stdin.wait_closed()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # ffmpeg stopped reading; _run reports why
+
+
+async def _probe_remote(url: str) -> Optional[str]:
+    # ffmpeg reads this URL itself: check it up front, so a missing or oversized
+    # file is rejected as a bad request before ffmpeg starts instead of
+    # surfacing as an ffmpeg error. Only a definite "not there" is fatal: hosts
+    # that refuse HEAD (405/501, or 403 on method-bound signed URLs), fail it,
+    # or leave out Content-Length are left to ffmpeg's own GET, like
+    # _url_validator does. Returns the URL's validator from the same HEAD.
+    try:
+        r = await HTTP.head(url, follow_redirects=True, timeout=30)
+    except httpx.TransportError:
+        return None
+    if r.status_code in (404, 410):
+        r.raise_for_status()
+    if not r.is_success:
+        return None
+    _check_input_size(r.url, _content_length(r) or 0)
+    return _response_validator(r)
+
+
+def _ffmpeg_can_stream(url: str) -> bool:
+    parsed = urlparse(url)
+    return parsed.scheme in ("http", "https") and parsed.hostname in MEDIA_URL_ALLOWLIST
+
+
+# Containers ffmpeg can decode from a non-seekable pipe (MP4/M4A may keep the
+# moov atom at the end of the file, so those are downloaded first).
+_PIPEABLE_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".opus", ".aac")
+
+
+async def _fetch_inputs(
+    td: str, inputs: dict[str, tuple[str, bool]], validate_voice: bool = False
+) -> tuple[dict[str, str], Optional[StdinFeeder], dict[str, Optional[str]]]:
+    # Resolve each named input (url, is_bed) to what ffmpeg should open:
+    # - music beds: a local file, from the bed cache when enabled (beds may be
+    #   looped with -stream_loop, which needs a seekable input)
+    # - allowlisted voice URL: the URL itself, so ffmpeg decodes while it downloads
+    #   (probed with a HEAD first)
+    # - other voice URLs in a pipeable container: pipe:0, fed by the returned
+    #   stdin feeder while ffmpeg runs
+    # - anything else: a file downloaded into the job tempdir
+    # Also returns the HTTP validators of voice inputs: taken from the probe's
+    # HEAD, or with validate_voice from a HEAD of their own overlapping the
+    # downloads.
+    sources: dict[str, str] = {}
+    stdin_feeder = None
+    jobs = []
+    probes = {}
+    for name, (url, is_bed) in inputs.items():
+        if not is_bed and _ffmpeg_can_stream(url):
+            sources[name] = url
+            probes[name] = _probe_remote(url)
+            continue
+        if not is_bed and validate_voice:
+            probes[name] = _url_validator(url)
+        if not is_bed and stdin_feeder is None and urlparse(url).path.lower().endswith(_PIPEABLE_EXTENSIONS):
+            sources[name] = "pipe:0"
+            stdin_feeder = functools.partial(_pipe_download, url)
+            continue
+        sources[name] = os.path.join(td, name)
+        jobs.append((_cached_download if is_bed else _download_to, sources[name], url))
+
+    _, *validators = await _gather_cancelling(_download_all(jobs), *probes.values())
+    return sources, stdin_feeder, dict(zip(probes, validators))
+
+
+async def _iter_file(f: IO[bytes], block_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+    while chunk := f.read(block_size):
+        yield chunk
+
+
+def _supabase_headers() -> dict[str, str]:
     if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
         raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY env vars")
 
-    upload_url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{object_path}"
-    headers = {
+    return {
         "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
         "apikey": SUPABASE_SERVICE_ROLE_KEY,
-        "Content-Type": content_type,
         "x-upsert": "true",
     }
 
+
+async def _supabase_upload(file_path: str, object_path: str, content_type: str = "audio/mpeg") -> str:
+    headers = _supabase_headers()
+
+    if os.path.getsize(file_path) >= RESUMABLE_UPLOAD_MIN_BYTES:
+        await _supabase_upload_resumable(file_path, object_path, content_type, headers)
+    else:
+        await _supabase_upload_single(file_path, object_path, content_type, headers)
+
+    return f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{object_path}"
+
+
+# Every storage request (uploads, TUS control requests, move/delete) fails fast
+# on connect but allows a slow storage backend to take its time
+_UPLOAD_TIMEOUT = httpx.Timeout(300, connect=10)
+
+
+async def _supabase_upload_single(
+    file_path: str,
+    object_path: str,
+    content_type: str,
+    headers: dict[str, str],
+    retries: int = 3,
+):
+    upload_url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{object_path}"
+    headers = {**headers, "Content-Type": content_type}
+
+    # The body is a file, so a 502/503/504 can simply be retried (x-upsert
+    # makes a repeat harmless).
+    for attempt in range(retries + 1):
+        status, text = await _post_file(upload_url, headers, file_path)
+        if status not in (502, 503, 504) or attempt == retries:
+            break
+        await asyncio.sleep(0.3 * 2 ** attempt)
+
+    if status not in (200, 201):
+        raise RuntimeError(f"Supabase upload failed: {status} {text[:800]}")
+
+
+async def _post_file(url: str, headers: dict[str, str], file_path: str) -> tuple[int, str]:
+    if urlparse(url).scheme == "http":
+        # Plain HTTP (self-hosted Supabase on a private network): let the
+        # kernel move the file to the socket. Over TLS the bytes have to be
+        # encrypted in userspace anyway, so httpx is used there.
+        return await _post_sendfile(url, headers, file_path)
+
     with open(file_path, "rb") as f:
-        r = requests.post(upload_url, headers=headers, data=f, timeout=240)
+        # An explicit Content-Length stops httpx from chunk-encoding the
+        # streamed body.
+        headers = {**headers, "Content-Length": str(os.fstat(f.fileno()).st_size)}
+        r = await HTTP.post(url, headers=headers, content=_iter_file(f), timeout=_UPLOAD_TIMEOUT)
+    return r.status_code, r.text
+
+
+async def _post_sendfile(url: str, headers: dict[str, str], file_path: str) -> tuple[int, str]:
+    # uvloop implements neither loop.sendfile nor loop.sock_sendfile, so the
+    # transfer runs on a blocking socket in a worker thread, where
+    # socket.sendfile is a real sendfile(2) under either event loop.
+    return await asyncio.to_thread(_post_sendfile_blocking, url, headers, file_path)
+
+
+def _post_sendfile_blocking(url: str, headers: dict[str, str], file_path: str) -> tuple[int, str]:
+    # Minimal HTTP/1.1 POST whose body goes file -> socket without passing
+    # through userspace. Connection: close lets us read the response to EOF
+    # instead of parsing its framing; only the status and a snippet of the
+    # body are used.
+    parsed = urlparse(url)
+    with socket.create_connection((parsed.hostname, parsed.port or 80), timeout=_UPLOAD_TIMEOUT.connect) as sock:
+        sock.settimeout(_UPLOAD_TIMEOUT.read)
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            head = [
+                f"POST {parsed.path} HTTP/1.1",
+                f"Host: {parsed.netloc}",
+                f"Content-Length: {size}",
+                "Connection: close",
+                *(f"{k}: {v}" for k, v in headers.items()),
+            ]
+            sock.sendall(("\r\n".join(head) + "\r\n\r\n").encode())
+            sock.sendfile(f)
+        response = b"".join(iter(lambda: sock.recv(65536), b""))
+
+    status_line, _, rest = response.partition(b"\r\n")
+    body = rest.partition(b"\r\n\r\n")[2]
+    return int(status_line.split()[1]), body.decode(errors="replace")
+
+
+# Supabase's TUS endpoint requires every PATCH except the last to be exactly 6 MiB
+TUS_CHUNK_SIZE = 6 * 1024 * 1024
+
+
+def _tus_metadata(**values: str) -> str:
+    return ",".join(f"{k} {base64.b64encode(v.encode()).decode()}" for k, v in values.items())
+
+
+async def _supabase_upload_resumable(
+    file_path: str,
+    object_path: str,
+    content_type: str,
+    headers: dict[str, str],
+    max_retries: int = 3,
+):
+    # TUS protocol: create the upload, then PATCH fixed-size chunks. A failed
+    # chunk only costs that chunk: we ask the server for its offset and resume
+    # from there instead of restarting the whole transfer.
+    size = os.path.getsize(file_path)
+    tus_headers = {**headers, "Tus-Resumable": "1.0.0"}
+
+    r = await HTTP.post(
+        f"{SUPABASE_URL}/storage/v1/upload/resumable",
+        headers={
+            **tus_headers,
+            "Upload-Length": str(size),
+            "Upload-Metadata": _tus_metadata(
+                bucketName=SUPABASE_BUCKET,
+                objectName=object_path,
+                contentType=content_type,
+            ),
+        },
+        timeout=_UPLOAD_TIMEOUT,
+    )
+    if r.status_code != 201:
+        raise RuntimeError(f"Supabase upload failed: {r.status_code} {r.text[:800]}")
+    location = urljoin(str(r.url), r.headers["Location"])
+
+    offset = 0
+    failures = 0
+    resync = False
+    with open(file_path, "rb") as f:
+        while offset < size:
+            try:
+                if resync:
+                    # After a failed chunk, ask the server how much it kept;
+                    # a failed HEAD counts against the same retry budget.
+                    r = await HTTP.head(location, headers=tus_headers, timeout=_UPLOAD_TIMEOUT)
+                    if r.is_success and "Upload-Offset" in r.headers:
+                        offset = int(r.headers["Upload-Offset"])
+                        resync = False
+                        continue
+                else:
+                    f.seek(offset)
+                    r = await HTTP.patch(
+                        location,
+                        headers={
+                            **tus_headers,
+                            "Upload-Offset": str(offset),
+                            "Content-Type": "application/offset+octet-stream",
+                        },
+                        content=f.read(TUS_CHUNK_SIZE),
+                        timeout=_UPLOAD_TIMEOUT,
+                    )
+                    if r.status_code == 204:
+                        offset = int(r.headers["Upload-Offset"])
+                        failures = 0
+                        continue
+                error = f"{r.status_code} {r.text[:800]}"
+            except httpx.TransportError as e:
+                error = str(e)
+
+            failures += 1
+            if failures > max_retries:
+                raise RuntimeError(f"Supabase upload failed: {error}")
+            resync = True
+
+
+async def _supabase_upload_stream(
+    stream: asyncio.StreamReader,
+    object_path: str,
+    content_type: str = "audio/mpeg",
+):
+    # Length is unknown while ffmpeg is still encoding, so httpx sends the
+    # generator body with chunked transfer-encoding.
+    headers = {**_supabase_headers(), "Content-Type": content_type}
+    upload_url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{object_path}"
+
+    async def body() -> AsyncIterator[bytes]:
+        while chunk := await stream.read(1024 * 1024):
+            yield chunk
+
+    r = await HTTP.post(upload_url, headers=headers, content=body(), timeout=_UPLOAD_TIMEOUT)
 
     if r.status_code not in (200, 201):
         raise RuntimeError(f"Supabase upload failed: {r.status_code} {r.text[:800]}")
 
-    return f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{object_path}"
+
+async def _supabase_move(source_path: str, object_path: str):
+    r = await HTTP.post(
+        f"{SUPABASE_URL}/storage/v1/object/move",
+        headers=_supabase_headers(),
+        json={"bucketId": SUPABASE_BUCKET, "sourceKey": source_path, "destinationKey": object_path},
+        timeout=_UPLOAD_TIMEOUT,
+    )
+    if r.status_code != 200:
+        raise RuntimeError(f"Supabase move failed: {r.status_code} {r.text[:800]}")
+
+
+async def _supabase_remove(object_path: str):
+    # Best effort: only used to clean up after a job that has already failed
+    try:
+        await HTTP.request(
+            "DELETE",
+            f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}",
+            headers=_supabase_headers(),
+            json={"prefixes": [object_path]},
+            timeout=_UPLOAD_TIMEOUT,
+        )
+    except httpx.HTTPError:
+        pass
 
 
-def _run(cmd: list[str]):
-    proc = subprocess.run(cmd, capture_output=True, text=True)
+async def _read_tail(stream: asyncio.StreamReader, limit: int = 8192) -> bytes:
+    # Only the end of ffmpeg's log is ever reported, so drain stderr into a
+    # bounded buffer instead of holding the whole run's output.
+    tail = bytearray()
+    while chunk := await stream.read(4096):
+        tail += chunk
+        del tail[:-limit]
+    return bytes(tail)
+
+
+# Bigger stdin pipe for the voice feeder so a short ffmpeg stall doesn't
+# immediately back-pressure the download (Linux only).
+STDIN_PIPE_SIZE = 1024 * 1024
+
+
+class _PipeWriterProtocol(asyncio.streams.FlowControlMixin):
+    # FlowControlMixin gives StreamWriter.drain() its flow control; wait_closed()
+    # also needs a waiter that resolves when the pipe is closed. Both are
+    # private asyncio internals, checked against Python 3.11 (the Dockerfile's
+    # python:3.11-slim); recheck when bumping the base image.
+    def __init__(self):
+        super().__init__()
+        self._closed = asyncio.get_running_loop().create_future()
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def _get_close_waiter(self, stream):
+        return self._closed
+
+
+async def _stdin_pipe() -> tuple[int, asyncio.StreamWriter]:
+    # ffmpeg's stdin for a feeder: (read end for the child, writer for us).
+    # Made here instead of with stdin=PIPE, whose buffer can't be grown under
+    # uvloop (it connects the child with a socketpair, not a pipe).
+    read_fd, write_fd = os.pipe()
+    try:
+        fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, STDIN_PIPE_SIZE)
+    except (AttributeError, OSError):
+        pass
+    try:
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.connect_write_pipe(_PipeWriterProtocol, os.fdopen(write_fd, "wb", buffering=0))
+    except BaseException:
+        os.close(read_fd)
+        raise
+    return read_fd, asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+async def _run(
+    cmd: list[str],
+    stdout_consumer: Optional[Callable[[asyncio.StreamReader], Awaitable[T]]] = None,
+    stdin_feeder: Optional[StdinFeeder] = None,
+) -> tuple[Optional[T], bytes]:
+    # Returns the stdout consumer's result and the tail of ffmpeg's stderr
+    _ffmpeg_jobs["waiting"] += 1
+    try:
+        await _FFMPEG_SLOTS.acquire()
+    finally:
+        _ffmpeg_jobs["waiting"] -= 1
+
+    _ffmpeg_jobs["running"] += 1
+    try:
+        return await _run_ffmpeg(cmd, stdout_consumer, stdin_feeder)
+    finally:
+        _ffmpeg_jobs["running"] -= 1
+        _FFMPEG_SLOTS.release()
+
+
+async def _run_ffmpeg(
+    cmd: list[str],
+    stdout_consumer: Optional[Callable[[asyncio.StreamReader], Awaitable[T]]],
+    stdin_feeder: Optional[StdinFeeder],
+) -> tuple[Optional[T], bytes]:
+    # asyncio subprocess: the event loop keeps serving other requests while
+    # ffmpeg runs, instead of parking a threadpool worker for the whole encode.
+    stdin_fd, stdin = await _stdin_pipe() if stdin_feeder else (asyncio.subprocess.DEVNULL, None)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=stdin_fd,
+            stdout=asyncio.subprocess.PIPE if stdout_consumer else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except BaseException:
+        if stdin and not stdin.transport.is_closing():
+            stdin.transport.abort()
+        raise
+    finally:
+        if stdin:
+            os.close(stdin_fd)  # the child has its own copy
+
+    # Drain stderr alongside everything else so ffmpeg can't block on a full
+    # pipe; stdout goes to the consumer while ffmpeg is still encoding and
+    # stdin is fed while it is still downloading.
+    aws = [_read_tail(proc.stderr)]
+    if stdout_consumer:
+        aws.append(stdout_consumer(proc.stdout))
+    if stdin:
+        aws.append(stdin_feeder(stdin))
+
+    try:
+        stderr, *results = await _gather_cancelling(*aws)
+        await proc.wait()
+    except BaseException:
+        # The feeder may have closed stdin already; aborting a closed pipe
+        # transport raises on stock asyncio
+        if stdin and not stdin.transport.is_closing():
+            stdin.transport.abort()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+
     if proc.returncode != 0:
-        raise RuntimeError(f"ffmpeg failed: {proc.stderr[-2500:]}")
+        raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace')[-2500:]}")
+    return (results[0] if stdout_consumer else None), stderr
+
+
+async def _render_and_upload(
+    cmd: list[str],
+    out_path: str,
+    object_path: str,
+    stdin_feeder: Optional[StdinFeeder] = None,
+    loudnorm_key: Optional[str] = None,
+    content_type: str = "audio/mpeg",
+) -> str:
+    # A job is exactly one ffmpeg process: trimming, stitching and
+    # normalization all live in the graph _ffmpeg_mix_cmd/_ffmpeg_podcast_cmd
+    # build, so keep new steps there rather than adding pre/post passes.
+    # loudnorm_key: record the measurement printed by a single-pass loudnorm
+    # under this key, so a repeat of the same mix can run the linear pass.
+    if STREAM_UPLOAD:
+        # The upload completes when ffmpeg closes stdout, which it also does
+        # when it fails: stream to a staging name and only move it into place
+        # once the exit status is known to be clean.
+        staging_path = f"{object_path}.{uuid.uuid4().hex}.part"
+        try:
+            _, stderr = await _run(
+                [*cmd, "pipe:1"],
+                stdout_consumer=functools.partial(
+                    _supabase_upload_stream, object_path=staging_path, content_type=content_type
+                ),
+                stdin_feeder=stdin_feeder,
+            )
+            await _supabase_move(staging_path, object_path)
+        except BaseException:
+            await _supabase_remove(staging_path)
+            raise
+        final_url = f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{object_path}"
+    else:
+        _, stderr = await _run([*cmd, out_path], stdin_feeder=stdin_feeder)
+        final_url = await _supabase_upload(out_path, object_path, content_type=content_type)
+
+    if loudnorm_key:
+        _save_loudnorm(loudnorm_key, stderr)
+    return final_url
+
+
+_LOUDNORM_TARGET = "loudnorm=I=-16:TP=-1.5:LRA=11"
+_LOUDNORM_FIELDS = ("input_i", "input_tp", "input_lra", "input_thresh", "target_offset")
+
+
+def _loudnorm_filter(fast: bool, measured: Optional[dict[str, str]] = None) -> str:
+    # dynaudnorm is a sliding-window gain stage: much cheaper than loudnorm's
+    # EBU R128 measurement + true-peak limiter, but not a compliant -16 LUFS target.
+    if fast:
+        return "dynaudnorm=f=200:g=15"
+    if measured:
+        # Loudness of this exact mix is already known: apply it as one linear
+        # gain instead of loudnorm's look-ahead dynamic mode.
+        return (
+            f"{_LOUDNORM_TARGET}:measured_I={measured['input_i']}:measured_TP={measured['input_tp']}"
+            f":measured_LRA={measured['input_lra']}:measured_thresh={measured['input_thresh']}"
+            f":offset={measured['target_offset']}:linear=true"
+        )
+    return f"{_LOUDNORM_TARGET}:print_format=json"
+
+
+async def _url_validator(url: str) -> Optional[str]:
+    # ETag / Last-Modified of a remote file, or None if it has neither
+    try:
+        r = await HTTP.head(url, follow_redirects=True, timeout=30)
+        r.raise_for_status()
+    except httpx.HTTPError:
+        return None
+    return _response_validator(r)
+
+
+def _response_validator(r: httpx.Response) -> Optional[str]:
+    validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+    return validator and f"{validator}|{r.headers.get('Content-Length', '')}"
+
+
+def _file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "blake2b").hexdigest()
+
+
+def _caches_loudnorm(req: BaseModel) -> bool:
+    return bool(CACHE_DIR) and req.loudnorm and not req.fast_loudnorm
+
+
+async def _loudnorm_key(req: BaseModel, voice: Optional[str], bed_paths: list[str]) -> Optional[str]:
+    # Everything that feeds loudnorm: the request's mix parameters, the voice
+    # (by HTTP validator, since it may never touch our disk) and the bed contents.
+    if not _caches_loudnorm(req) or voice is None:
+        return None
+    beds = await asyncio.to_thread(lambda: [_file_digest(p) for p in bed_paths])
+    h = hashlib.blake2b(type(req).__name__.encode())
+    for part in (req.model_dump_json(), voice, *beds):
+        h.update(b"\0" + part.encode())
+    return h.hexdigest()
+
+
+def _load_loudnorm(key: Optional[str]) -> Optional[dict[str, str]]:
+    if not key:
+        return None
+    path = os.path.join(CACHE_DIR, key + ".loudnorm")
+    try:
+        with open(path) as f:
+            measured = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        os.utime(path)  # mark as recently used for eviction
+    except OSError:
+        pass
+    return measured
+
+
+def _save_loudnorm(key: str, stderr: bytes):
+    # loudnorm's print_format=json block is the last {...} in ffmpeg's stderr
+    text = stderr.decode(errors="replace")
+    try:
+        end = text.rindex("}") + 1
+        stats = json.loads(text[text.rindex("{", 0, end):end])
+        measured = {k: stats[k] for k in _LOUDNORM_FIELDS}
+        if not all(math.isfinite(float(v)) for v in measured.values()):
+            return  # e.g. silent input measures -inf
+    except (ValueError, KeyError):
+        return
+
+    # Runs after the upload: a cache that can't be written just drops the
+    # measurement instead of failing a job whose file is already published.
+    path = os.path.join(CACHE_DIR, key + ".loudnorm")
+    part = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(part, "w") as f:
+            json.dump(measured, f)
+        os.replace(part, path)
+    except OSError:
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+
+
+def _input_args(src: str, *opts: str) -> list[str]:
+    args = ["-thread_queue_size", "1024"]
+    if src.startswith(("http://", "https://")):
+        # Remote input read by ffmpeg itself: survive dropped connections and
+        # never let a playlist/redirect pull in file: or other protocols.
+        args += [
+            "-reconnect", "1",
+            "-reconnect_streamed", "1",
+            "-reconnect_delay_max", "5",
+            "-protocol_whitelist", "http,https,tcp,tls",
+        ]
+    return [*args, *opts, "-i", src]
+
+
+_FFMPEG_THREAD_ARGS = [
+    "-filter_threads", str(FFMPEG_FILTER_THREADS),
+    "-filter_complex_threads", str(FFMPEG_FILTER_THREADS),
+]
+
+# LAME VBR (default -q:a 4, ~165 kbps) encodes faster than 192k CBR at
+# equivalent quality for speech; compression_level 5 picks a faster LAME
+# algorithm, and the Xing header gives players an accurate VBR duration.
+_MP3_OUTPUT_ARGS = [
+    "-ar", "44100",
+    "-ac", "2",
+    "-c:a", "libmp3lame",
+    "-q:a", str(MP3_VBR_QUALITY),
+    "-compression_level", str(MP3_COMPRESSION_LEVEL),
+    "-joint_stereo", "1",
+    "-write_xing", "1",
+    "-threads", str(FFMPEG_THREADS),
+    "-f", "mp3",
+]
+
+# Opus in Ogg: speech at 64k sounds like a much larger MP3, and libopus encodes
+# faster than LAME. "audio" rather than "voip" tuning because of the music.
+_OPUS_OUTPUT_ARGS = [
+    "-ar", "48000",
+    "-ac", "2",
+    "-c:a", "libopus",
+    "-b:a", OPUS_BITRATE,
+    "-vbr", "on",
+    "-application", "audio",
+    "-f", "opus",
+]
+
+# output_format -> (ffmpeg output args, upload Content-Type); the key doubles
+# as the file extension
+OUTPUT_FORMATS = {
+    "mp3": (_MP3_OUTPUT_ARGS, "audio/mpeg"),
+    "opus": (_OPUS_OUTPUT_ARGS, "audio/ogg"),
+}
 
 
 # =========================
 # ffmpeg: simple mix (voice + bed)
 # =========================
-def _run_ffmpeg_mix(
-    voice_path: str,
-    music_path: str,
-    out_path: str,
+# - Loop music to cover voice length (input-level -stream_loop, not aloop,
+#   which would buffer the whole bed in memory)
+# - Set music volume
+# - Optional ducking (sidechain keyed on an asplit copy of the voice)
+# - Mix duration = voice
+# - Optional loudnorm
+_MIX_GRAPHS = {
+    True: (
+        "[0:a]asplit=2[voice][key];"
+        "[1:a]volume={vol}[m];"
+        "[m][key]sidechaincompress=threshold=0.02:ratio=8:attack=5:release=2000[bg];"
+        "[voice][bg]amix=inputs=2:duration=first:dropout_transition=3[mix]"
+    ),
+    False: (
+        "[1:a]volume={vol}[m];"
+        "[0:a][m]amix=inputs=2:duration=first:dropout_transition=3[mix]"
+    ),
+}
+
+# (duck, loudnorm) -> (filter_complex template, output label); only the music
+# volume and the normalization filter are filled in per request.
+MIX_TEMPLATES = {
+    (duck, loudnorm): (graph + ";[mix]{norm}[out]", "[out]") if loudnorm else (graph, "[mix]")
+    for duck, graph in _MIX_GRAPHS.items()
+    for loudnorm in (True, False)
+}
+
+
+def _ffmpeg_mix_cmd(
+    voice_src: str,
+    music_src: str,
     music_volume: float,
     duck: bool,
     loudnorm: bool,
-):
-    # - Loop music to cover voice length
-    # - Set music volume
-    # - Optional ducking (sidechain)
-    # - Mix duration = voice
-    # - Optional loudnorm
-    if duck:
-        filter_complex = (
-            f"[1:a]aloop=loop=-1:size=2147483647,volume={music_volume}[m];"
-            f"[m][0:a]sidechaincompress=threshold=0.02:ratio=8:attack=5:release=2000[bg];"
-            f"[0:a][bg]amix=inputs=2:duration=first:dropout_transition=3[mix]"
-        )
-    else:
-        filter_complex = (
-            f"[1:a]aloop=loop=-1:size=2147483647,volume={music_volume}[m];"
-            f"[0:a][m]amix=inputs=2:duration=first:dropout_transition=3[mix]"
-        )
-
-    if loudnorm:
-        filter_complex += ";[mix]loudnorm=I=-16:TP=-1.5:LRA=11[out]"
-        out_map = "[out]"
-    else:
-        out_map = "[mix]"
-
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", voice_path,
-        "-i", music_path,
+    fast_loudnorm: bool = False,
+    loudnorm_measured: Optional[dict[str, str]] = None,
+    output_format: str = "mp3",
+) -> list[str]:
+    template, out_map = MIX_TEMPLATES[(duck, loudnorm)]
+    filter_complex = template.format(vol=music_volume, norm=_loudnorm_filter(fast_loudnorm, loudnorm_measured))
+
+    return [
+        "ffmpeg", "-y", "-hide_banner", "-nostats",
+        *_FFMPEG_THREAD_ARGS,
+        *_input_args(voice_src),
+        *_input_args(music_src, "-stream_loop", "-1"),
         "-filter_complex", filter_complex,
         "-map", out_map,
-        "-ar", "44100",
-        "-ac", "2",
-        "-b:a", "192k",
-        out_path,
+        *OUTPUT_FORMATS[output_format][0],
     ]
-    _run(cmd)
 
 
 # =========================
 # ffmpeg: intro + voice + outro with smooth transitions + fades
 # =========================
-def _run_ffmpeg_podcast(
-    voice_path: str,
-    intro_path: str,
-    outro_path: str,
-    out_path: str,
+_FORMAT_CHAIN = "aresample=44100:resampler=soxr,aformat=sample_fmts=fltp:channel_layouts=stereo"
+
+# Stitching (avoid duplicating voice), by (has intro, has outro) ->
+# (acrossfade graph, stitched label). acrossfade duration cannot exceed the
+# shortest segment; ffmpeg handles but keep sane.
+_PODCAST_STITCH = {
+    # Case A: intro + voice + outro (normal)
+    (True, True): (
+        "[intro][voice]acrossfade=d={t}:c1=tri:c2=tri[iv];"
+        "[iv][outro]acrossfade=d={t}:c1=tri:c2=tri[full]",
+        "[full]",
+    ),
+    # Case B: intro + voice only
+    (True, False): ("[intro][voice]acrossfade=d={t}:c1=tri:c2=tri[full]", "[full]"),
+    # Case C: voice + outro only
+    (False, True): ("[voice][outro]acrossfade=d={t}:c1=tri:c2=tri[full]", "[full]"),
+    # Case D: just voice
+    (False, False): ("", "[voice]"),
+}
+
+# (has intro, has outro, loudnorm) -> (stitch/normalize template, output label);
+# only the transition length and the normalization filter are filled in per request.
+PODCAST_TEMPLATES = {
+    (has_intro, has_outro, loudnorm): (
+        (";".join(filter(None, (graph, label + "{norm}[out]"))), "[out]") if loudnorm else (graph, label)
+    )
+    for (has_intro, has_outro), (graph, label) in _PODCAST_STITCH.items()
+    for loudnorm in (True, False)
+}
+
+
+# Intro/outro chain skeletons, by shape; only the filter values are filled in per request.
+@functools.lru_cache(maxsize=None)
+def _segment_template(input_index: int, label: str, volume: bool, fade_in: bool, fade_out: bool) -> str:
+    chain = f"[{input_index}:a]{_FORMAT_CHAIN},asetpts=N/SR/TB"
+    if volume:
+        chain += ",volume={vol}"
+    if fade_in:
+        chain += ",afade=t=in:st=0:d={fade_in}"
+    if fade_out:
+        chain += ",afade=t=out:st={fade_out_start}:d={fade_out}"
+    return chain + f"[{label}]"
+
+
+def _segment_chain(input_index: int, label: str, duration: float, volume: float, fade_in: float, fade_out: float) -> str:
+    template = _segment_template(input_index, label, volume != 1.0, fade_in > 0, fade_out > 0)
+    return template.format(
+        vol=volume,
+        fade_in=fade_in,
+        fade_out=fade_out,
+        fade_out_start=max(0.0, float(duration) - float(fade_out)),
+    )
+
+
+def _ffmpeg_podcast_cmd(
+    voice_src: str,
+    intro_src: Optional[str],
+    outro_src: Optional[str],
     intro_duration: float,
     outro_duration: float,
     transition_seconds: float,
@@ -162,10 +1175,13 @@ def _run_ffmpeg_podcast(
     outro_fade_in: float,
     outro_fade_out: float,
     loudnorm: bool,
-):
+    fast_loudnorm: bool = False,
+    loudnorm_measured: Optional[dict[str, str]] = None,
+    output_format: str = "mp3",
+) -> list[str]:
     # Normalize each input to the same format for stable crossfades
     # Then:
-    # 1) trim intro/outro to durations (if >0)
+    # 1) trim intro/outro to durations (if >0) with input-side -t
     # 2) apply volume + fade in/out on intro/outro
     # 3) acrossfade intro -> voice, then voice -> outro
     # acrossfade ends up with smooth transitions without duplicating voice.
@@ -183,93 +1199,38 @@ def _run_ffmpeg_podcast(
 
     filter_parts = []
 
-    # Base format blocks
-    filter_parts.append(
-        "[0:a]aresample=44100,aformat=sample_fmts=fltp:channel_layouts=stereo,asetpts=N/SR/TB[voice]"
-    )
-    filter_parts.append(
-        "[1:a]aresample=44100,aformat=sample_fmts=fltp:channel_layouts=stereo,asetpts=N/SR/TB[intro_raw]"
-    )
-    filter_parts.append(
-        "[2:a]aresample=44100,aformat=sample_fmts=fltp:channel_layouts=stereo,asetpts=N/SR/TB[outro_raw]"
-    )
+    # Base format block (soxr: SIMD resampler, Debian's ffmpeg is built with libsoxr).
+    # Intro/outro get theirs at the head of their own chains, and are only
+    # added as inputs when used; they are trimmed with input-side -t, so ffmpeg
+    # stops reading them at the duration instead of decoding the whole file.
+    filter_parts.append(f"[0:a]{_FORMAT_CHAIN},asetpts=N/SR/TB[voice]")
+    input_args = _input_args(voice_src)
+    next_input = 1
 
-    # Intro processing
+    # Intro/outro processing
     if intro_duration > 0:
-        fade_out_start = max(0.0, float(intro_duration) - float(intro_fade_out))
-        intro_chain = (
-            f"[intro_raw]atrim=0:{intro_duration},asetpts=N/SR/TB,volume={intro_volume}"
-        )
-        if intro_fade_in > 0:
-            intro_chain += f",afade=t=in:st=0:d={intro_fade_in}"
-        if intro_fade_out > 0:
-            intro_chain += f",afade=t=out:st={fade_out_start}:d={intro_fade_out}"
-        intro_chain += "[intro]"
-        filter_parts.append(intro_chain)
-        intro_label = "[intro]"
-    else:
-        # If intro_duration == 0, skip intro and start from voice
-        intro_label = None
-
-    # Outro processing
+        filter_parts.append(_segment_chain(next_input, "intro", intro_duration, intro_volume, intro_fade_in, intro_fade_out))
+        input_args += _input_args(intro_src, "-t", str(intro_duration))
+        next_input += 1
     if outro_duration > 0:
-        fade_out_start = max(0.0, float(outro_duration) - float(outro_fade_out))
-        outro_chain = (
-            f"[outro_raw]atrim=0:{outro_duration},asetpts=N/SR/TB,volume={outro_volume}"
-        )
-        if outro_fade_in > 0:
-            outro_chain += f",afade=t=in:st=0:d={outro_fade_in}"
-        if outro_fade_out > 0:
-            outro_chain += f",afade=t=out:st={fade_out_start}:d={outro_fade_out}"
-        outro_chain += "[outro]"
-        filter_parts.append(outro_chain)
-        outro_label = "[outro]"
-    else:
-        outro_label = None
-
-    # Stitching logic (avoid duplicating voice)
-    # Case A: intro + voice + outro (normal)
-    if intro_label and outro_label:
-        # acrossfade duration cannot exceed the shortest segment; ffmpeg handles but keep sane
-        filter_parts.append(f"{intro_label}[voice]acrossfade=d={t}:c1=tri:c2=tri[iv]")
-        filter_parts.append(f"[iv]{outro_label}acrossfade=d={t}:c1=tri:c2=tri[full]")
-        final_label = "[full]"
-
-    # Case B: intro + voice only
-    elif intro_label and not outro_label:
-        filter_parts.append(f"{intro_label}[voice]acrossfade=d={t}:c1=tri:c2=tri[full]")
-        final_label = "[full]"
+        filter_parts.append(_segment_chain(next_input, "outro", outro_duration, outro_volume, outro_fade_in, outro_fade_out))
+        input_args += _input_args(outro_src, "-t", str(outro_duration))
 
-    # Case C: voice + outro only
-    elif (not intro_label) and outro_label:
-        filter_parts.append(f"[voice]{outro_label}acrossfade=d={t}:c1=tri:c2=tri[full]")
-        final_label = "[full]"
-
-    # Case D: just voice
-    else:
-        final_label = "[voice]"
-
-    if loudnorm:
-        filter_parts.append(f"{final_label}loudnorm=I=-16:TP=-1.5:LRA=11[out]")
-        out_map = "[out]"
-    else:
-        out_map = final_label
+    # Stitch + normalize from the precomputed templates
+    template, out_map = PODCAST_TEMPLATES[(intro_duration > 0, outro_duration > 0, loudnorm)]
+    if template:
+        filter_parts.append(template.format(t=t, norm=_loudnorm_filter(fast_loudnorm, loudnorm_measured)))
 
     filter_complex = ";".join(filter_parts)
 
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", voice_path,
-        "-i", intro_path,
-        "-i", outro_path,
+    return [
+        "ffmpeg", "-y", "-hide_banner", "-nostats",
+        *_FFMPEG_THREAD_ARGS,
+        *input_args,
         "-filter_complex", filter_complex,
         "-map", out_map,
-        "-ar", "44100",
-        "-ac", "2",
-        "-b:a", "192k",
-        out_path,
+        *OUTPUT_FORMATS[output_format][0],
     ]
-    _run(cmd)
 
 
 # =========================
@@ -283,36 +1244,130 @@ def root():
 
 @app.get("/health")
 def health():
-    return {"ok": True}
+    # Job slots of this worker, for readiness checks / load balancing
+    return {
+        "ok": True,
+        "max_concurrent_jobs": MAX_CONCURRENT_JOBS,
+        "jobs_running": _ffmpeg_jobs["running"],
+        "jobs_waiting": _ffmpeg_jobs["waiting"],
+    }
 
 
-@app.post("/mix")
-def mix(req: MixRequest):
-    if req.output_format.lower() != "mp3":
-        raise HTTPException(status_code=400, detail="Only output_format=mp3 is supported right now")
+def _output_format(value: str) -> str:
+    fmt = value.lower()
+    if fmt not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"output_format must be one of: {', '.join(OUTPUT_FORMATS)}")
+    return fmt
+
+
+def _job_state_path(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def _write_job(job_id: str, state: dict):
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    path = _job_state_path(job_id)
+    with open(path + ".part", "w") as f:
+        json.dump({"job_id": job_id, **state}, f)
+    os.replace(path + ".part", path)
 
+
+def _prune_jobs():
+    cutoff = time.time() - JOB_TTL_SECONDS
+    for entry in os.scandir(JOBS_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+async def _run_background_job(job: Callable[[BaseModel, str], Awaitable[dict]], req: BaseModel, job_id: str):
+    _write_job(job_id, {"status": "running"})
+    try:
+        result = await job(req, job_id)
+    except HTTPException as e:
+        _write_job(job_id, {"status": "failed", "status_code": e.status_code, "detail": e.detail})
+    else:
+        _write_job(job_id, {"status": "done", "result": result})
+
+
+async def _submit(
+    job: Callable[[BaseModel, str], Awaitable[dict]],
+    req: BaseModel,
+    background_tasks: BackgroundTasks,
+    background: bool,
+):
     job_id = str(uuid.uuid4())
-    out_object = f"{OUTPUT_PREFIX}/{job_id}.mp3"
+    if not background:
+        return await job(req, job_id)
+
+    # Answer right away and render after the response has been sent; the
+    # client polls /jobs/{job_id} instead of holding the connection open.
+    _write_job(job_id, {"status": "queued"})
+    _prune_jobs()
+    background_tasks.add_task(_run_background_job, job, req, job_id)
+    return ORJSONResponse(
+        status_code=202,
+        content={"ok": True, "job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"},
+    )
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    try:
+        uuid.UUID(job_id)
+        # The state file is already JSON; hand it back as-is
+        with open(_job_state_path(job_id), "rb") as f:
+            return Response(content=f.read(), media_type="application/json")
+    except (ValueError, FileNotFoundError):
+        raise HTTPException(status_code=404, detail="Unknown job_id")
+
+
+@app.post("/mix")
+async def mix(req: MixRequest, background_tasks: BackgroundTasks, background: bool = False):
+    _output_format(req.output_format)
+    return await _submit(_mix_job, req, background_tasks, background)
+
+
+@app.post("/mix_podcast")
+async def mix_podcast(req: MixPodcastRequest, background_tasks: BackgroundTasks, background: bool = False):
+    _output_format(req.output_format)
+    return await _submit(_mix_podcast_job, req, background_tasks, background)
+
+
+async def _mix_job(req: MixRequest, job_id: str) -> dict:
+    fmt = _output_format(req.output_format)
+    out_object = f"{OUTPUT_PREFIX}/{job_id}.{fmt}"
 
     try:
-        with tempfile.TemporaryDirectory() as td:
-            voice_path = os.path.join(td, "voice")
-            music_path = os.path.join(td, "music")
-            out_path = os.path.join(td, "final.mp3")
-
-            _download_to(voice_path, str(req.voice_url))
-            _download_to(music_path, str(req.music_url))
-
-            _run_ffmpeg_mix(
-                voice_path=voice_path,
-                music_path=music_path,
-                out_path=out_path,
+        with tempfile.TemporaryDirectory(dir=_job_tmpdir()) as td:
+            out_path = os.path.join(td, f"final.{fmt}")
+
+            src, stdin_feeder, validators = await _fetch_inputs(td, {
+                "voice": (req.voice_url, False),
+                "music": (req.music_url, True),
+            }, validate_voice=_caches_loudnorm(req))
+
+            norm_key = await _loudnorm_key(req, validators.get("voice"), [src["music"]])
+            measured = _load_loudnorm(norm_key)
+
+            cmd = _ffmpeg_mix_cmd(
+                voice_src=src["voice"],
+                music_src=src["music"],
                 music_volume=req.music_volume,
                 duck=req.duck,
                 loudnorm=req.loudnorm,
+                fast_loudnorm=req.fast_loudnorm,
+                loudnorm_measured=measured,
+                output_format=fmt,
             )
 
-            final_url = _supabase_upload(out_path, out_object, content_type="audio/mpeg")
+            final_url = await _render_and_upload(
+                cmd, out_path, out_object, stdin_feeder,
+                loudnorm_key=None if measured else norm_key,
+                content_type=OUTPUT_FORMATS[fmt][1],
+            )
 
         return {
             "ok": True,
@@ -322,33 +1377,38 @@ def mix(req: MixRequest):
             "object_path": out_object,
         }
 
-    except requests.HTTPError as e:
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=400, detail=f"Download failed: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/mix_podcast")
-def mix_podcast(req: MixPodcastRequest):
-    job_id = str(uuid.uuid4())
-    out_object = f"{OUTPUT_PREFIX}/{job_id}.mp3"
+async def _mix_podcast_job(req: MixPodcastRequest, job_id: str) -> dict:
+    fmt = _output_format(req.output_format)
+    out_object = f"{OUTPUT_PREFIX}/{job_id}.{fmt}"
 
     try:
-        with tempfile.TemporaryDirectory() as td:
-            voice_path = os.path.join(td, "voice")
-            intro_path = os.path.join(td, "intro")
-            outro_path = os.path.join(td, "outro")
-            out_path = os.path.join(td, "final.mp3")
-
-            _download_to(voice_path, str(req.voice_url))
-            _download_to(intro_path, str(req.intro_music_url))
-            _download_to(outro_path, str(req.outro_music_url))
-
-            _run_ffmpeg_podcast(
-                voice_path=voice_path,
-                intro_path=intro_path,
-                outro_path=outro_path,
-                out_path=out_path,
+        with tempfile.TemporaryDirectory(dir=_job_tmpdir()) as td:
+            out_path = os.path.join(td, f"final.{fmt}")
+
+            # intro/outro with a zero duration are left out of the mix entirely
+            inputs = {"voice": (req.voice_url, False)}
+            if req.intro_duration > 0:
+                inputs["intro"] = (req.intro_music_url, True)
+            if req.outro_duration > 0:
+                inputs["outro"] = (req.outro_music_url, True)
+            src, stdin_feeder, validators = await _fetch_inputs(td, inputs, validate_voice=_caches_loudnorm(req))
+            beds = [src[name] for name in ("intro", "outro") if name in src]
+
+            norm_key = await _loudnorm_key(req, validators.get("voice"), beds)
+            measured = _load_loudnorm(norm_key)
+
+            cmd = _ffmpeg_podcast_cmd(
+                voice_src=src["voice"],
+                intro_src=src.get("intro"),
+                outro_src=src.get("outro"),
                 intro_duration=req.intro_duration,
                 outro_duration=req.outro_duration,
                 transition_seconds=req.transition_seconds,
@@ -359,9 +1419,16 @@ def mix_podcast(req: MixPodcastRequest):
                 outro_fade_in=req.outro_fade_in,
                 outro_fade_out=req.outro_fade_out,
                 loudnorm=req.loudnorm,
+                fast_loudnorm=req.fast_loudnorm,
+                loudnorm_measured=measured,
+                output_format=fmt,
             )
 
-            final_url = _supabase_upload(out_path, out_object, content_type="audio/mpeg")
+            final_url = await _render_and_upload(
+                cmd, out_path, out_object, stdin_feeder,
+                loudnorm_key=None if measured else norm_key,
+                content_type=OUTPUT_FORMATS[fmt][1],
+            )
 
         return {
             "ok": True,
@@ -371,7 +1438,9 @@ def mix_podcast(req: MixPodcastRequest):
             "object_path": out_object,
         }
 
-    except requests.HTTPError as e:
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=400, detail=f"Download failed: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+# Every job is exactly one ffmpeg process: trimming, stitching and loudness
+# normalization all belong in the one filter graph.
+CASES = [
+    ("/mix", {"voice_url": "https://media.example/voice.mp3", "music_url": "https://media.example/bed.mp3"}),
+    ("/mix", {
+        "voice_url": "https://media.example/voice.mp3",
+        "music_url": "https://media.example/bed.mp3",
+        "duck": False,
+        "fast_loudnorm": True,
+        "output_format": "opus",
+    }),
+    ("/mix_podcast", {
+        "voice_url": "https://media.example/voice.mp3",
+        "intro_music_url": "https://media.example/intro.mp3",
+        "outro_music_url": "https://media.example/outro.mp3",
+    }),
+    ("/mix_podcast", {
+        "voice_url": "https://media.example/voice.mp3",
+        "intro_music_url": "https://media.example/intro.mp3",
+        "outro_music_url": "https://media.example/outro.mp3",
+        "intro_duration": 0,
+        "loudnorm": False,
+    }),
+]
+
+
+@pytest.fixture
+def ffmpeg_runs(monkeypatch):
+    runs = []
+
+    async def fetch_inputs(td, inputs, validate_voice=False):
+        return {name: os.path.join(td, name) for name in inputs}, None, {}
+
+    async def run(cmd, stdout_consumer=None, stdin_feeder=None):
+        runs.append(cmd)
+        with open(cmd[-1], "wb") as f:
+            f.write(b"rendered")
+        return None, b""
+
+    async def upload(file_path, object_path, content_type="audio/mpeg"):
+        return f"https://storage.example/{object_path}"
+
+    monkeypatch.setattr(main, "STREAM_UPLOAD", False)
+    monkeypatch.setattr(main, "_fetch_inputs", fetch_inputs)
+    monkeypatch.setattr(main, "_run", run)
+    monkeypatch.setattr(main, "_supabase_upload", upload)
+    return runs
+
+
+@pytest.mark.parametrize("path,body", CASES)
+def test_one_ffmpeg_run_per_job(ffmpeg_runs, path, body):
+    r = TestClient(main.app).post(path, json=body)
+
+    assert r.status_code == 200, r.text
+    assert len(ffmpeg_runs) == 1
+    assert ffmpeg_runs[0][0] == "ffmpeg"